@@ -0,0 +1,96 @@
+import os
+import sys
+import warnings
+from autumn.db.schema import Index
+
+_package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_tests = os.path.join(_package, 'tests')
+
+def _outside_stacklevel():
+    '''
+    Returns the ``warnings.warn`` stacklevel, for its caller, of the first
+    frame outside Autumn itself (its tests count as outside)
+    '''
+    # Frame 2 is the caller of the function calling warnings.warn
+    level, frame = 2, sys._getframe(2)
+    while frame is not None:
+        path = os.path.abspath(frame.f_code.co_filename)
+        if not path.startswith(_package + os.sep) or path.startswith(_tests + os.sep):
+            break
+        level, frame = level + 1, frame.f_back
+    return level
+
+class FullScanWarning(UserWarning):
+    pass
+
+class IndexAdvisor(object):
+    '''
+    Development aid that explains each distinct query shape run through
+    ``Query`` and warns when a filter or ``order_by`` column forces a full
+    table scan (or a sort the database has to do itself).
+    
+    Enable it per connection container::
+    
+        autumn_db.advisor = IndexAdvisor()
+        
+        # ... exercise the application ...
+        
+        print autumn_db.advisor.report()
+        
+    A shape is the table, the filtered columns and the ordering; values are
+    ignored, so each shape is explained only once. Filtered columns include
+    those of the ``IN (...)`` lookups that batch-load relations.
+    '''
+    
+    def __init__(self, warn=True):
+        self.warn = warn
+        self.plans = {}
+        self.suggestions = {}
+        
+    def record(self, query, query_type=None):
+        'Explains ``query`` if its shape has not been seen yet'
+        columns = tuple(sorted(query.conditions))
+        for field, sql, values in query._extra:
+            if field not in columns:
+                columns += (field,)
+        shape = (query.model.Meta.table, query_type or query.type, columns, query.order)
+        if shape in self.plans:
+            return
+        plan = query.explain(query_type)
+        self.plans[shape] = plan
+        
+        scan, sort = self.inspect(query.db.conn.dbtype, plan)
+        if not (scan and columns) and not (sort and query.order_field):
+            return
+        index = columns
+        if query.order_field and query.order_field not in index:
+            index += (query.order_field,)
+        self.suggestions.setdefault(query.model.Meta.table, set()).add(index)
+        if self.warn:
+            problem = scan and columns and 'a full scan' or 'a sort'
+            warnings.warn('%s filtered on %s and ordered by %s needs %s; consider an index on (%s)' % (
+                query.model.__name__, ', '.join(columns) or 'nothing',
+                query.order_field or 'nothing', problem, ', '.join(index),
+            ), FullScanWarning, stacklevel=_outside_stacklevel())
+        
+    def inspect(self, dbtype, plan):
+        'Returns ``(full_scan, sort)`` flags for a plan from ``Query.explain``'
+        scan = sort = False
+        for row in plan:
+            if dbtype == 'mysql':
+                scan = scan or row.get('type') == 'ALL'
+                sort = sort or 'Using filesort' in (row.get('Extra') or '')
+            else:
+                detail = row.get('detail', '')
+                scan = scan or (detail.startswith('SCAN') and 'CONSTANT ROW' not in detail)
+                sort = sort or detail.startswith('USE TEMP B-TREE FOR ORDER BY')
+        return scan, sort
+        
+    def report(self):
+        'Returns the suggested indexes as ``CREATE INDEX`` statements'
+        lines = []
+        for table in sorted(self.suggestions):
+            lines.append('-- %s' % table)
+            for columns in sorted(self.suggestions[table]):
+                lines.append('%s;' % Index(*columns).create_sql(table))
+        return '\n'.join(lines)
@@ -1,21 +1,58 @@
-        
+
+# Connect-time tuning for SQLite, passed as ``profile`` to ``Database.connect``
+# or ``util.AutoConn``. Every key but ``cached_statements`` (the size of the
+# sqlite3 module's statement cache) is issued as a PRAGMA. Copy and adjust it
+# with ``dict(PERFORMANCE_PROFILE, synchronous='FULL')``.
+PERFORMANCE_PROFILE = {
+    'busy_timeout': 5000,           # milliseconds
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,           # negative means KiB, i.e. 64MB
+    'mmap_size': 268435456,         # 256MB of memory-mapped reads
+    'temp_store': 'MEMORY',
+    'cached_statements': 256,
+}
+
 class Database(object):
     placeholder = '?'
+    dbtype = 'sqlite3'
     
     def connect(self, dbtype, *args, **kwargs):
+        self.dbtype, self.args, self.kwargs = dbtype, args, dict(kwargs)
+        profile = kwargs.pop('profile', None) or {}
         if dbtype == 'sqlite3':
             import sqlite3
-            self.connection = sqlite3.connect(*args)
+            if 'cached_statements' in profile:
+                self.connection = sqlite3.connect(*args, cached_statements=profile['cached_statements'])
+            else:
+                self.connection = sqlite3.connect(*args)
+            self.apply_profile(profile)
         elif dbtype == 'mysql':
             import MySQLdb
             self.connection = MySQLdb.connect(**kwargs)
             self.placeholder = '%s'
+            
+    def apply_profile(self, profile):
+        'Issues a PRAGMA for each setting in a SQLite ``profile``'
+        cursor = self.connection.cursor()
+        # Set the busy timeout first so the other pragmas wait out any locks
+        names = sorted(profile, key=lambda name: name != 'busy_timeout')
+        for name in names:
+            if name != 'cached_statements':
+                cursor.execute('PRAGMA %s = %s' % (name, profile[name]))
+        cursor.close()
+            
+    def reconnect(self):
+        'Opens a new connection using the arguments last given to ``connect``'
+        self.connect(self.dbtype, *self.args, **self.kwargs)
 
 class DBConn(object):
     def __init__(self):
         self.b_debug = False
         self.b_commit = True
         self.conn = None
+        self.writer = None
+        self.advisor = None
 
 autumn_db = DBConn()
 autumn_db.conn = Database()
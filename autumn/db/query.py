@@ -1,6 +1,14 @@
+from array import array
+import multiprocessing
+import weakref
 from autumn.db import escape
 from autumn.db.connection import autumn_db
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Query(object):
     '''
     Gives quick access to database by setting attributes (query conditions, et
@@ -53,6 +61,45 @@ class Query(object):
     COUNT(*)`` instead of a ``SELECT *``. ``count`` returns an integer::
         
         count = Query(model=MyModel).filter=(name='John').count()
+        
+    For analytics, ``columns`` skips building model instances altogether and
+    returns a dictionary of column name to column values. Numeric columns are
+    packed into compact ``array.array`` objects (or NumPy arrays when NumPy is
+    installed); anything else comes back as a list. NULLs in a numeric column
+    become NaN, so an integer column holding NULLs comes back as floats. A
+    column mixing NULLs or floats with integers too large to be exact as
+    floats comes back as a list. Rows are
+    streamed from the cursor ``chunk_size`` at a time::
+    
+        cols = Query(model=Book).filter(author_id=1).columns('id', 'price')
+        total = sum(cols['price'])
+        
+    CPU-heavy work over many rows can be spread across processes with
+    ``parallel_map``. The query's primary keys are cut into slices of
+    ``chunk_size`` rows, and each slice is loaded and mapped by a worker
+    process holding its own database connection. ``func`` must be picklable
+    (a module-level function)::
+    
+        for result in Query(model=MyModel).parallel_map(func, workers=4):
+            # results arrive in primary key order
+            
+        # or as soon as each slice is done
+        Query(model=MyModel).parallel_map(func, ordered=False)
+        
+    Relations (``ForeignKey``, ``OneToMany``) on objects loaded by the same
+    query are fetched together: the first time one object touches a
+    relation, it is loaded for all of them with ``IN (...)`` queries, so
+    looping over ``book.author`` costs one query rather than one per book.
+    Turn this off for a query with ``batch_relations``::
+    
+        for book in Query(model=Book).batch_relations(False):
+            book.author # one query per book
+        
+    ``explain`` returns the database's plan for the query (``EXPLAIN QUERY
+    PLAN`` on SQLite, ``EXPLAIN`` on MySQL) as a list of dictionaries. To
+    have plans checked as queries run, see ``autumn.db.advisor``::
+    
+        plan = Query(model=MyModel).filter(name='John').explain()
             
     Class Methods
     -------------
@@ -68,6 +115,9 @@ class Query(object):
     ``Query.sql(sql, values)`` has the same syntax as ``Query.raw_sql``, but 
     it returns a dictionary of the result, the field names being the keys.
     
+    ``Query.raw_sqlmany(sql, values_list)`` runs ``sql`` once per sequence in
+    ``values_list`` using the cursor's ``executemany``.
+    
     '''
     
     def __init__(self, query_type='SELECT *', conditions={}, model=None, db=None):
@@ -75,8 +125,14 @@ class Query(object):
         self.type = query_type
         self.conditions = conditions
         self.order = ''
+        self.order_field = None
         self.limit = ()
         self.cache = None
+        # Results shared with copies, see share_results
+        self._shared = None
+        self.batch = True
+        # Extra (field, sql, values) WHERE clauses, e.g. ranges and IN lists
+        self._extra = []
         if not issubclass(model, Model):
             raise Exception('Query objects must be created with a model class.')
         self.model = model
@@ -90,6 +146,7 @@ class Query(object):
             return self.cache[k]
         
         if isinstance(k, (int, long)):
+            self._shared = None
             self.limit = (k,1)
             lst = self.get_data()
             if not lst:
@@ -99,8 +156,10 @@ class Query(object):
             if k.start is not None:
                 assert k.stop is not None, "Limit must be set when an offset is present"
                 assert k.stop >= k.start, "Limit must be greater than or equal to offset"
+                self._shared = None
                 self.limit = k.start, (k.stop - k.start)
             elif k.stop is not None:
+                self._shared = None
                 self.limit = 0, k.stop
         
         return self.get_data()
@@ -116,29 +175,96 @@ class Query(object):
         
     def count(self):
         if self.cache is None:
-            self.type = 'SELECT COUNT(*)'
-            return self.execute_query().fetchone()[0]
+            return self.execute_query('SELECT COUNT(*)').fetchone()[0]
         else:
             return len(self.cache)
         
+    def columns(self, *fields, **kwargs):
+        '''
+        Returns a dict of ``field: column`` for ``fields`` (all of the model's
+        fields by default) without creating model instances.
+        '''
+        chunk_size = kwargs.get('chunk_size', 1000)
+        fields = fields or self.model._fields
+        query_type = 'SELECT %s' % ', '.join(escape(f) for f in fields)
+        cursor = self.execute_query(query_type)
+        cols = [_ColumnBuilder() for f in fields]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for col, values in zip(cols, zip(*rows)):
+                col.extend(values)
+        return dict((field, col.result()) for field, col in zip(fields, cols))
+        
     def filter(self, **kwargs):
         self.conditions.update(kwargs)
+        self.cache = None
+        self._shared = None
+        return self
+        
+    def batch_relations(self, enabled=True):
+        self.batch = enabled
         return self
         
     def order_by(self, field, direction='ASC'):
+        self.cache = None
+        self._shared = None
         self.order = 'ORDER BY %s %s' % (escape(field), direction)
+        self.order_field = field
         return self
         
+    def parallel_map(self, func, workers=None, chunk_size=1000, ordered=True):
+        '''
+        Yields ``func(obj)`` for every object matched by the query, running
+        ``func`` in a pool of ``workers`` processes (one per CPU by default).
+        '''
+        # Every chunk_size-th key (in key order) starts a slice, so slices
+        # hold about chunk_size rows however sparse the keys are
+        keys = Query(model=self.model, conditions=dict(self.conditions), db=self.db)
+        keys._extra = list(self._extra)
+        keys.order_by(self.model.Meta.pk)
+        cursor = keys.execute_query('SELECT %s' % escape(self.model.Meta.pk))
+        bounds = []
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            bounds.append(rows[0][0])
+        if not bounds:
+            return
+        
+        slices = [(self.model, dict(self.conditions), list(self._extra), (low, high), func)
+                  for low, high in zip(bounds, bounds[1:] + [None])]
+        pool = multiprocessing.Pool(workers, _parallel_init, (self.db,))
+        try:
+            if ordered:
+                results = pool.imap(_parallel_slice, slices)
+            else:
+                results = pool.imap_unordered(_parallel_slice, slices)
+            for chunk in results:
+                for result in chunk:
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        
     def extract_condition_keys(self):
-        if len(self.conditions):
-            return 'WHERE %s' % ' AND '.join("%s=%s" % (escape(k), self.db.conn.placeholder) for k in self.conditions)
+        keys = ["%s=%s" % (escape(k), self.db.conn.placeholder) for k in self.conditions]
+        keys.extend(sql for field, sql, values in self._extra)
+        if keys:
+            return 'WHERE %s' % ' AND '.join(keys)
         
     def extract_condition_values(self):
-        return list(self.conditions.itervalues())
+        values = list(self.conditions.itervalues())
+        for field, sql, extra_values in self._extra:
+            values.extend(extra_values)
+        return values
         
-    def query_template(self):
+    def query_template(self, query_type=None):
         return '%s FROM %s %s %s %s' % (
-            self.type,
+            query_type or self.type,
             self.model.Meta.table_safe,
             self.extract_condition_keys() or '',
             self.order,
@@ -152,17 +278,59 @@ class Query(object):
     def get_data(self):
         if self.cache is None:
             self.cache = list(self.iterator())
+            if self._shared is not None:
+                self._shared[0] = self.cache
         return self.cache
         
+    def copy(self):
+        'Returns a new Query for the same rows'
+        q = Query(self.type, dict(self.conditions), self.model, self.db)
+        q.order, q.order_field, q.limit = self.order, self.order_field, self.limit
+        q.batch, q._extra = self.batch, list(self._extra)
+        q.cache, q._shared = self.cache, self._shared
+        if self._shared is not None and self._shared[0] is not None:
+            q.cache = self._shared[0]
+        return q
+        
+    def share_results(self, rows=None):
+        '''
+        Makes this Query and its copies share results: whichever loads them
+        first (unsliced and unfiltered) saves the others a query. Slicing,
+        ``filter`` or ``order_by`` detach a copy from the shared results.
+        '''
+        self.cache = rows
+        self._shared = [rows]
+        
     def iterator(self):        
+        # Objects from one query share a list of (weak references to) their
+        # siblings so relations can be loaded for all of them at once, without
+        # one live object keeping the whole result set alive
+        siblings = None
+        if self.batch:
+            siblings = []
         for row in self.execute_query().fetchall():
             obj = self.model(*row)
             obj._new_record = False
+            if siblings is not None:
+                obj._siblings = siblings
+                siblings.append(weakref.ref(obj))
             yield obj
             
-    def execute_query(self):
+    def explain(self, query_type=None):
+        'Returns the database\'s plan for the query as a list of dictionaries'
+        if self.db.conn.dbtype == 'mysql':
+            prefix = 'EXPLAIN'
+        else:
+            prefix = 'EXPLAIN QUERY PLAN'
+        sql = '%s %s' % (prefix, self.query_template(query_type))
+        return Query.sql(sql, self.extract_condition_values(), self.db)
+        
+    def execute_query(self, query_type=None):
+        advisor = getattr(self.db, 'advisor', None)
+        if advisor is not None:
+            advisor.record(self, query_type)
         values = self.extract_condition_values()
-        return Query.raw_sql(self.query_template(), values, self.db)
+        return Query.raw_sql(self.query_template(query_type), values, self.db)
         
     @classmethod
     def get_db(cls, db=None):
@@ -185,8 +353,12 @@ class Query(object):
     @classmethod
     def raw_sql(cls, sql, values=(), db=None):
         db = db or cls.get_db()
-        cursor = cls.get_cursor(db)
+        writer = getattr(db, 'writer', None)
         try:
+            # Writes go through the single writer thread when there is one
+            if writer is not None and writer.handles(sql):
+                return writer.execute(sql, values)
+            cursor = cls.get_cursor(db)
             cursor.execute(sql, values)
             if db.b_commit:
                 db.conn.connection.commit()
@@ -198,6 +370,24 @@ class Query(object):
             raise
         return cursor
 
+    @classmethod
+    def raw_sqlmany(cls, sql, values_list, db=None):
+        db = db or cls.get_db()
+        writer = getattr(db, 'writer', None)
+        try:
+            if writer is not None and writer.handles(sql):
+                return writer.execute(sql, values_list, many=True)
+            cursor = cls.get_cursor(db)
+            cursor.executemany(sql, values_list)
+            if db.b_commit:
+                db.conn.connection.commit()
+        except BaseException, ex:
+            if db.b_debug:
+                print "raw_sqlmany: exception: ", ex
+                print "sql:", sql
+            raise
+        return cursor
+
     @classmethod
     def raw_sqlscript(cls, sql, db=None):
         db = db or cls.get_db()
@@ -241,3 +431,112 @@ class Query(object):
         finally:
             db.b_commit = True
         return cursor
+
+
+# Connections inherited from the parent process are kept referenced so they
+# are never closed (and so never torn down on the server) from a worker.
+_inherited_connections = []
+
+# The database a parallel_map worker reads through, set up by _parallel_init.
+# It can't travel with each slice since connections don't pickle.
+_worker_db = None
+
+def _parallel_init(db):
+    'Gives each ``parallel_map`` worker process its own database connection'
+    global _worker_db
+    _inherited_connections.append(db.conn.connection)
+    db.conn.reconnect()
+    _worker_db = db
+
+def _parallel_slice(args):
+    'Runs ``func`` over one primary key slice of a ``parallel_map`` query'
+    model, conditions, extra, (low, high), func = args
+    q = Query(model=model, conditions=conditions, db=_worker_db)
+    q._extra = extra
+    pk, ph = escape(model.Meta.pk), q.db.conn.placeholder
+    if high is None:
+        q._extra.append((model.Meta.pk, '%s >= %s' % (pk, ph), [low]))
+    else:
+        q._extra.append((model.Meta.pk, '%s >= %s AND %s < %s' % (pk, ph, pk, ph), [low, high]))
+    q.order_by(model.Meta.pk)
+    return [func(obj) for obj in q.iterator()]
+
+# Integers beyond this can't be stored exactly in a float column
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+
+def _exact_as_float(values):
+    'Returns True if every integer in ``values`` is exact as a float'
+    for v in values:
+        if isinstance(v, (int, long)) and abs(v) > _MAX_EXACT_FLOAT_INT:
+            return False
+    return True
+
+class _ColumnBuilder(object):
+    """
+    Accumulates one column for ``Query.columns``. Integer columns are packed
+    into ``array('l')`` and float columns into ``array('d')``. NULLs in a
+    numeric column are stored as NaN, which turns an integer column into a
+    float one. Anything that doesn't fit, including integers too large to
+    be exact in a float column, ends up in a plain list.
+    """
+    def __init__(self):
+        self.data = None        # not started while every value is NULL
+        self.nulls = 0          # leading NULLs seen before data started
+        
+    def extend(self, values):
+        if self.data is None:
+            kinds = set(type(v) for v in values if v is not None)
+            if not kinds:
+                self.nulls += len(values)
+                return
+            if kinds <= set([int, long, bool]):
+                self.data = array('l')
+            elif kinds <= set([int, long, bool, float]):
+                self.data = array('d')
+            else:
+                self.data = []
+            if self.nulls:
+                self._append([None] * self.nulls)
+        self._append(values)
+        
+    def _append(self, values):
+        data = self.data
+        if isinstance(data, array):
+            numeric = all(v is None or isinstance(v, (int, long, float)) for v in values)
+            if numeric and data.typecode == 'l' and \
+               any(v is None or isinstance(v, float) for v in values):
+                data = self._promote(data)
+            if isinstance(data, array) and data.typecode == 'd' and \
+               not _exact_as_float(values):
+                numeric = False
+            if isinstance(data, array) and numeric:
+                try:
+                    data.extend(array(data.typecode, [float('nan') if v is None else v for v in values]))
+                    self.data = data
+                    return
+                except (TypeError, OverflowError):
+                    pass
+            data = self._demote(data)
+        data.extend(values)
+        self.data = data
+        
+    def _promote(self, data):
+        'Turns an integer array into a float array, if that is exact'
+        if not _exact_as_float(data):
+            return self._demote(data)
+        return array('d', data)
+        
+    def _demote(self, data):
+        'Turns an array into a list, with NaN back to None'
+        if not isinstance(data, array):
+            return data
+        if data.typecode == 'd':
+            return [None if v != v else v for v in data]
+        return data.tolist()
+        
+    def result(self):
+        if self.data is None:
+            return [None] * self.nulls
+        if numpy is not None and isinstance(self.data, array):
+            return numpy.frombuffer(self.data, dtype=self.data.typecode)
+        return self.data
@@ -1,7 +1,23 @@
+from autumn.db import escape
 from autumn.db.query import Query
 from autumn.model import cache
 
 class Relation(object):
+    '''
+    Base for relation descriptors. The related object (or ``Query``) is
+    memoized on the instance until the field it depends on is changed, or
+    until ``Model.refresh()`` is called.
+    
+    For an instance loaded by a ``Query``, the relation is loaded at once for
+    every sibling from the same query that doesn't have it yet, using
+    ``IN (...)`` queries of up to ``batch_size`` keys.
+    
+    Subclasses set, in ``_set_up``, the field on the instance (``local``)
+    that must equal the field on the related model (``remote``), and whether
+    the relation is to ``many`` objects.
+    '''
+    batch_size = 500
+    many = False
     
     def __init__(self, model, field=None):            
         self.model = model
@@ -10,25 +26,78 @@ class Relation(object):
     def _set_up(self, instance, owner):
         if isinstance(self.model, basestring):
             self.model = cache.get(self.model)
-
-class ForeignKey(Relation):
+            
+    def depends_on(self, instance):
+        'Returns the name of the field on ``instance`` this relation is keyed by'
+        return self.local
         
     def __get__(self, instance, owner):
-        super(ForeignKey, self)._set_up(instance, owner)
+        self._set_up(instance, owner)
         if not instance:
             return self.model
+        related = instance._related
+        if self not in related:
+            siblings = instance._get_siblings()
+            if len(siblings) > 1:
+                self.load_many([s for s in siblings if self not in s._related])
+            else:
+                related[self] = self.load(instance)
+        if self.many:
+            # Hand out a copy so slicing or filtering it leaves the
+            # memoized Query (and the rows it shares) untouched
+            return related[self].copy()
+        return related[self]
+        
+    def load(self, instance):
+        'Looks up the relation for ``instance``; a ``Query`` is left unrun'
+        q = Query(model=self.model, conditions={self.remote: getattr(instance, self.local)})
+        if self.many:
+            q.share_results()
+            return q
+        return q[0]
+        
+    def load_many(self, instances):
+        'Looks up the relation for all of ``instances`` at once'
+        keys = set(getattr(i, self.local) for i in instances)
+        keys.discard(None)
+        groups = dict((key, []) for key in keys)
+        for obj in self.select_in(self.remote, keys):
+            groups[getattr(obj, self.remote)].append(obj)
+        for i in instances:
+            rows = groups.get(getattr(i, self.local), [])
+            if self.many:
+                # A Query already holding its results; count() and slicing
+                # use them
+                q = Query(model=self.model, conditions={self.remote: getattr(i, self.local)})
+                q.share_results(rows)
+                i._related[self] = q
+            else:
+                i._related[self] = rows and rows[0] or None
+        
+    def select_in(self, field, keys):
+        'Yields objects of the related model whose ``field`` is in ``keys``'
+        keys = list(keys)
+        for start in xrange(0, len(keys), self.batch_size):
+            chunk = keys[start:start + self.batch_size]
+            q = Query(model=self.model, conditions={})
+            ph = q.db.conn.placeholder
+            q._extra.append((field, '%s IN (%s)' % (escape(field), ', '.join([ph] * len(chunk))), chunk))
+            for obj in q.iterator():
+                yield obj
+
+class ForeignKey(Relation):
+    
+    def _set_up(self, instance, owner):
+        super(ForeignKey, self)._set_up(instance, owner)
         if not self.field:
             self.field = '%s_id' % self.model.Meta.table
-        conditions = {self.model.Meta.pk: getattr(instance, self.field)}
-        return Query(model=self.model, conditions=conditions)[0]
+        self.local, self.remote = self.field, self.model.Meta.pk
 
 class OneToMany(Relation):
+    many = True
     
-    def __get__(self, instance, owner):
+    def _set_up(self, instance, owner):
         super(OneToMany, self)._set_up(instance, owner)
-        if not instance:
-            return self.model
         if not self.field:
-            self.field = '%s_id' % instance.Meta.table
-        conditions = {self.field: getattr(instance, instance.Meta.pk)}
-        return Query(model=self.model, conditions=conditions)
\ No newline at end of file
+            self.field = '%s_id' % owner.Meta.table
+        self.local, self.remote = owner.Meta.pk, self.field
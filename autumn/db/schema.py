@@ -0,0 +1,74 @@
+from autumn.db import escape
+
+class Index(object):
+    '''
+    An index declared in a model's ``Meta.indexes``::
+    
+        class Book(Model):
+            class Meta:
+                indexes = (
+                    ('author_id', 'title'),             # plain tuples work too
+                    'published',                        # and so do strings
+                    Index('isbn', unique=True),
+                    Index('title', name='book_titles'),
+                )
+    '''
+    def __init__(self, *columns, **kwargs):
+        assert columns, "An index needs at least one column"
+        self.columns = tuple(columns)
+        self.unique = kwargs.get('unique', False)
+        self.name = kwargs.get('name')
+        
+    def get_name(self, table):
+        return self.name or '%s_%s_%s' % (
+            self.unique and 'uidx' or 'idx', table, '_'.join(self.columns))
+        
+    def create_sql(self, table):
+        return 'CREATE %sINDEX %s ON %s (%s)' % (
+            self.unique and 'UNIQUE ' or '',
+            escape(self.get_name(table)), escape(table),
+            ', '.join(escape(c) for c in self.columns),
+        )
+        
+    def satisfied_by(self, existing):
+        '''
+        Returns True if one of ``existing``, a list of ``(columns, unique)``
+        pairs, covers this index.
+        '''
+        for columns, unique in existing:
+            if columns == self.columns and (unique or not self.unique):
+                return True
+        return False
+
+def create_table_sql(table, columns):
+    'Returns ``CREATE TABLE`` for ``columns``, a sequence of (name, type)'
+    return 'CREATE TABLE %s (%s)' % (
+        escape(table), ', '.join('%s %s' % (escape(name), type) for name, type in columns))
+
+def table_exists(db, table):
+    'Checks the catalog (``sqlite_master`` / ``information_schema``) for ``table``'
+    from autumn.db.query import Query
+    ph = db.conn.placeholder
+    if db.conn.dbtype == 'mysql':
+        sql = ('SELECT COUNT(*) FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s' % ph)
+    else:
+        sql = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s" % ph
+    return Query.raw_sql(sql, (table,), db).fetchone()[0] > 0
+
+def existing_indexes(db, table):
+    'Returns the indexes on ``table`` as a list of ``(columns, unique)`` pairs'
+    from autumn.db.query import Query
+    indexes = {}
+    if db.conn.dbtype == 'mysql':
+        sql = ('SELECT index_name, non_unique, column_name FROM information_schema.statistics '
+               'WHERE table_schema = DATABASE() AND table_name = %s '
+               'ORDER BY index_name, seq_in_index' % db.conn.placeholder)
+        for name, non_unique, column in Query.raw_sql(sql, (table,), db).fetchall():
+            indexes.setdefault((name, not non_unique), []).append(column)
+    else:
+        for row in Query.raw_sql('PRAGMA index_list(%s)' % escape(table), db=db).fetchall():
+            name, unique = row[1], row[2]
+            info = Query.raw_sql('PRAGMA index_info(%s)' % escape(name), db=db).fetchall()
+            indexes[(name, bool(unique))] = [column for seqno, cid, column in info]
+    return [(tuple(columns), unique) for (name, unique), columns in indexes.items()]
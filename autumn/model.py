@@ -1,6 +1,7 @@
 from autumn.db.query import Query
 from autumn.db import escape
 from autumn.db.connection import autumn_db, Database
+from autumn.db.schema import Index
 from autumn.validators import ValidatorChain
     
 class ModelCache(object):
@@ -23,7 +24,7 @@ class ModelBase(type):
     
     Sets up default table name and primary key
     Adds fields from table as attributes
-    Creates ValidatorChains as necessary
+    Creates ValidatorChains and Indexes as necessary
     
     '''
     def __new__(cls, name, bases, attrs):
@@ -48,13 +49,31 @@ class ModelBase(type):
             if isinstance(v, (list, tuple)):
                 new_class.Meta.validations[k] = ValidatorChain(*v)
         
+        # A string is one column, a tuple or list several
+        indexes = []
+        for i in getattr(new_class.Meta, 'indexes', None) or ():
+            if isinstance(i, basestring):
+                i = Index(i)
+            elif not isinstance(i, Index):
+                i = Index(*i)
+            indexes.append(i)
+        if indexes:
+            new_class.Meta.indexes = indexes
+        
         # See cursor.description
         # http://www.python.org/dev/peps/pep-0249/
         if not hasattr(new_class, "db"):
             new_class.db = autumn_db
         db = new_class.db
-        q = Query.raw_sql('SELECT * FROM %s LIMIT 1' % new_class.Meta.table_safe, db=new_class.db)
-        new_class._fields = [f[0] for f in q.description]
+        try:
+            q = Query.raw_sql('SELECT * FROM %s LIMIT 1' % new_class.Meta.table_safe, db=new_class.db)
+            new_class._fields = [f[0] for f in q.description]
+        except Exception:
+            # Declared columns let the table be created later by
+            # util.ensure_schema
+            if not getattr(new_class.Meta, 'columns', None):
+                raise
+            new_class._fields = [c[0] for c in new_class.Meta.columns]
         
         cache.add(new_class)
         return new_class
@@ -66,6 +85,7 @@ class Model(object):
     Syntax::
     
         from autumn.model import Model
+        from autumn.db.schema import Index
         class MyModel(Model):
             class Meta:
                 # If field is blank, this sets a default value on save
@@ -79,6 +99,14 @@ class Model(object):
                 # Table name is lower-case model name by default
                 # Or we can set the table name
                 table = 'mytable'
+                
+                # Optional column types and indexes, used by
+                # autumn.util.ensure_schema to create the table and any
+                # missing indexes
+                columns = (('id', 'INTEGER PRIMARY KEY'),
+                           ('field', 'INTEGER'),
+                           ('text', 'VARCHAR(255)'))
+                indexes = (('field', 'text'), Index('text', unique=True))
         
         # Create new instance using args based on the order of columns
         m = MyModel(1, 'A string')
@@ -98,6 +126,11 @@ class Model(object):
         # Deleting removes from the database 
         m.delete()
         
+        # Insert-or-update many objects without reading them first, matching
+        # existing rows on the primary key (or any unique columns)
+        MyModel.upsert([MyModel(id=1, field=2), MyModel(id=9, field=3)])
+        MyModel.upsert(objs, conflict=('text',), update_fields=['field'])
+        
         # Purely saving with an improper value, checked against 
         # Model.Meta.validations[field_name] will raise Model.ValidationError
         m = MyModel(field=0)
@@ -140,6 +173,12 @@ class Model(object):
         m = MyModel.get(field=1).order_by('field', 'DESC')
         # Removing the second argument defaults the order to ASC
         
+        # Related objects (ForeignKey, OneToMany) are looked up once and
+        # remembered until the field they are keyed by changes
+        
+        # Reload fields from the database and forget related objects
+        m.refresh()
+        
     '''
     __metaclass__ = ModelBase
     
@@ -149,6 +188,7 @@ class Model(object):
         'Allows setting of fields using kwargs'
         self.__dict__[self.Meta.pk] = None
         self._new_record = True
+        self._related = {}
         [setattr(self, self._fields[i], arg) for i, arg in enumerate(args)]
         [setattr(self, k, v) for k, v in kwargs.iteritems()]
         self._changed = set()
@@ -157,8 +197,19 @@ class Model(object):
         'Records when fields have changed'
         if name != '_changed' and name in self._fields and hasattr(self, '_changed'):
             self._changed.add(name)
+        if name in self._fields and self.__dict__.get('_related'):
+            # Forget related objects looked up through the old value
+            for relation in self._related.keys():
+                if relation.depends_on(self) == name:
+                    del self._related[relation]
         self.__dict__[name] = value
         
+    def _get_siblings(self):
+        'Returns the objects, still in use, loaded by the same query as this one'
+        refs = self.__dict__.get('_siblings') or ()
+        siblings = [obj for obj in (ref() for ref in refs) if obj is not None]
+        return siblings or [self]
+        
     def _get_pk(self):
         'Sets the current value of the primary key'
         return getattr(self, self.Meta.pk, None)
@@ -208,6 +259,16 @@ class Model(object):
                     v = v()
                 setattr(self, k, v)
         
+    def refresh(self):
+        'Reloads fields from the database and forgets memoized relations'
+        cursor = Query(model=self.__class__, conditions={self.Meta.pk: self._get_pk()}).execute_query()
+        row = cursor.fetchone()
+        if row is None:
+            raise self.DoesNotExist('No %s with %s %r' % (self.__class__.__name__, self.Meta.pk, self._get_pk()))
+        self.__dict__.update(zip(self._fields, row))
+        self._changed = set()
+        self._related = {}
+        
     def delete(self):
         'Deletes record from database'
         query = 'DELETE FROM %s WHERE %s = %s' % (self.Meta.table_safe, self.Meta.pk, self.db.conn.placeholder)
@@ -242,6 +303,65 @@ class Model(object):
         else:
             return self._update()
             
+    @classmethod
+    def upsert(cls, objs, conflict=None, update_fields=None, batch_size=500):
+        '''
+        Inserts ``objs``, updating the existing row instead wherever one
+        conflicts on the ``conflict`` columns (the primary key by default).
+        ``update_fields`` defaults to every field outside ``conflict`` except
+        the primary key. Rows are written with ``executemany`` in batches of
+        ``batch_size``.
+        
+        Every object needs a value for each ``conflict`` column. Objects
+        without a primary key are written but not marked as saved, since the
+        key the database gave them isn't known.
+        
+        Where a row already existed, fields outside ``update_fields`` keep
+        their stored values, so on the objects those fields are left marked
+        as changed; a later ``save()`` writes them.
+        '''
+        objs = list(objs)
+        conflict = tuple(conflict or (cls.Meta.pk,))
+        if update_fields is None:
+            update_fields = [f for f in cls._fields
+                             if f not in conflict and f != cls.Meta.pk]
+        for obj in objs:
+            obj._get_defaults()
+            obj._validate()
+            for f in conflict:
+                if getattr(obj, f, None) is None:
+                    raise Model.ValidationError, 'Improper value "None" for "%s"' % f
+        
+        query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            cls.Meta.table_safe,
+            ', '.join(escape(f) for f in cls._fields),
+            ', '.join([cls.db.conn.placeholder] * len(cls._fields)),
+        )
+        if cls.db.conn.dbtype == 'mysql':
+            # MySQL needs at least one assignment; a no-op keeps the old row
+            assignments = ['%s = VALUES(%s)' % (escape(f), escape(f)) for f in update_fields]
+            query += ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+                assignments or ['%s = %s' % (escape(conflict[0]), escape(conflict[0]))])
+        else:
+            query += ' ON CONFLICT (%s)' % ', '.join(escape(f) for f in conflict)
+            if update_fields:
+                query += ' DO UPDATE SET %s' % ', '.join(
+                    '%s = excluded.%s' % (escape(f), escape(f)) for f in update_fields)
+            else:
+                query += ' DO NOTHING'
+        
+        for start in xrange(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            values = [[getattr(obj, f, None) for f in cls._fields] for obj in batch]
+            Query.raw_sqlmany(query, values, cls.db)
+        written = set(conflict) | set(update_fields)
+        for obj in objs:
+            if obj._get_pk() is not None:
+                obj._new_record = False
+                obj._changed = set(f for f in cls._fields
+                                   if f not in written and f != cls.Meta.pk)
+        return True
+        
     @classmethod
     def get(cls, _obj_pk=None, **kwargs):
         'Returns Query object'
@@ -253,3 +373,6 @@ class Model(object):
         
     class ValidationError(Exception):
         pass
+        
+    class DoesNotExist(Exception):
+        pass
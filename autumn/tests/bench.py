@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Compares SQLite's default settings against PERFORMANCE_PROFILE.
+
+Each run inserts rows one statement (and one commit) at a time, as
+``Model.save()`` does, then reads them back by primary key.
+
+    python -m autumn.tests.bench [rows]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from autumn.db.connection import Database, DBConn, PERFORMANCE_PROFILE
+from autumn.db.query import Query
+
+def run(rows, profile=None):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'bench.db')
+    db = DBConn()
+    db.conn = Database()
+    db.conn.connect('sqlite3', path, profile=profile)
+    Query.raw_sql('CREATE TABLE bench (id INTEGER PRIMARY KEY, value TEXT)', db=db)
+    
+    start = time.time()
+    for i in xrange(rows):
+        Query.raw_sql('INSERT INTO bench (value) VALUES (?)', ('row %d' % i,), db)
+    writes = time.time() - start
+    
+    start = time.time()
+    for i in xrange(1, rows + 1):
+        Query.raw_sql('SELECT * FROM bench WHERE id = ?', (i,), db).fetchone()
+    reads = time.time() - start
+    
+    db.conn.connection.close()
+    shutil.rmtree(tmpdir)
+    return writes, reads
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print '%d rows, one commit per insert' % rows
+    print '%-12s %12s %12s' % ('', 'writes/s', 'reads/s')
+    for name, profile in (('default', None), ('performance', PERFORMANCE_PROFILE)):
+        writes, reads = run(rows, profile)
+        print '%-12s %12.0f %12.0f' % (name, rows / writes, rows / reads)
@@ -1,11 +1,25 @@
 #!/usr/bin/env python
 import unittest
 import datetime
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import warnings
 from autumn.model import Model
 from autumn.tests.models import Book, Author
 from autumn.db.query import Query
 from autumn.db import escape
-from autumn import validators
+from autumn.db.advisor import IndexAdvisor, FullScanWarning
+from autumn.db.schema import Index, existing_indexes
+from autumn.db.connection import PERFORMANCE_PROFILE, Database, DBConn
+from autumn import validators, util
+
+def full_name(author):
+    return '%s %s' % (author.first_name, author.last_name)
 
 class TestModels(unittest.TestCase):
         
@@ -122,6 +136,403 @@ class TestModels(unittest.TestCase):
         except Model.ValidationError:
             pass
             
+    def testcolumns(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        
+        ids = []
+        for name in ('Ann', 'Bob', 'Cy'):
+            a = Author(first_name=name, last_name='Smith')
+            a.save()
+            ids.append(a.id)
+        
+        cols = Author.get(last_name='Smith').order_by('id').columns('id', 'first_name', chunk_size=2)
+        self.assertEqual(list(cols['id']), ids)
+        self.assertEqual(list(cols['first_name']), ['Ann', 'Bob', 'Cy'])
+        self.assert_(isinstance(cols['first_name'], list))
+        
+        Book(title='One', author_id=ids[0]).save()
+        Book(title='Two', author_id=None).save()
+        Book(title='Three', author_id=ids[1]).save()
+        cols = Book.get().order_by('id').columns('author_id', chunk_size=1)
+        author_ids = list(cols['author_id'])
+        self.assertEqual(author_ids[0], ids[0])
+        self.assert_(author_ids[1] != author_ids[1]) # NaN
+        self.assertEqual(author_ids[2], ids[1])
+        self.assert_(not isinstance(cols['author_id'], list))
+        
+        # NULLs sort first, so the first chunk holds nothing but NULL
+        cols = Book.get().order_by('author_id').columns('author_id', chunk_size=1)
+        author_ids = list(cols['author_id'])
+        self.assert_(author_ids[0] != author_ids[0])
+        self.assertEqual(author_ids[1:], sorted(ids[:2]))
+        
+        # Integers too large to be exact as floats keep the column a list,
+        # whether they arrive before or after it holds floats
+        from autumn.db.query import _ColumnBuilder
+        col = _ColumnBuilder()
+        col.extend((1, 2))
+        col.extend((2 ** 60, None))
+        self.assertEqual(col.result(), [1, 2, 2 ** 60, None])
+        col = _ColumnBuilder()
+        col.extend((1.5, None))
+        col.extend((2 ** 60 + 1,))
+        self.assertEqual(col.result(), [1.5, None, 2 ** 60 + 1])
+        
+        cols = Author.get(last_name='Nobody').columns()
+        self.assertEqual(sorted(cols.keys()), sorted(Author._fields))
+        self.assertEqual(len(cols['id']), 0)
+        
+    def testparallelmap(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        
+        for name in ('Ann', 'Bob', 'Cy', 'Di', 'Ed'):
+            Author(first_name=name, last_name='Smith').save()
+        
+        expected = [full_name(a) for a in Author.get().order_by('id')]
+        results = Author.get().parallel_map(full_name, workers=2, chunk_size=2)
+        self.assertEqual(list(results), expected)
+        results = Author.get().parallel_map(full_name, workers=2, chunk_size=2, ordered=False)
+        self.assertEqual(sorted(results), sorted(expected))
+        self.assertEqual(list(Author.get(last_name='Nobody').parallel_map(full_name)), [])
+        
+        # Sparse keys still make slices of chunk_size rows
+        Author(id=10 ** 9, first_name='Far', last_name='Away').save()
+        results = Author.get().parallel_map(full_name, workers=2, chunk_size=4)
+        self.assertEqual(list(results), expected + ['Far Away'])
+        
+        # A query's own db is the one each worker reconnects and reads from
+        path = tempfile.mktemp(suffix='.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE author (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, bio TEXT)')
+        conn.execute("INSERT INTO author VALUES (1, 'Other', 'Db', NULL)")
+        conn.commit()
+        conn.close()
+        q = Query(model=Author, conditions={}, db=util.AutoConn(path))
+        self.assertEqual(list(q.parallel_map(full_name, workers=1)), ['Other Db'])
+        os.remove(path)
+        
+    def testupsert(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        
+        ann = Author(first_name='Ann', last_name='Smith')
+        ann.save()
+        
+        Author.upsert([
+            Author(id=ann.id, first_name='Anne', last_name='Smyth'),
+            Author(id=ann.id + 1, first_name='Bob', last_name='Jones'),
+        ], batch_size=1)
+        self.assertEqual(Author.get().count(), 2)
+        self.assertEqual(Author.get(ann.id).first_name, 'Anne')
+        self.assertEqual(Author.get(ann.id + 1).bio, 'No bio available')
+        
+        ann = Author(id=ann.id, first_name='Ann', last_name='Smith')
+        Author.upsert([ann], update_fields=['last_name'])
+        a = Author.get(ann.id)
+        self.assertEqual((a.first_name, a.last_name), ('Anne', 'Smith'))
+        
+        # Fields the upsert may not have written are saved later
+        self.assertEqual(ann._changed, set(['first_name', 'bio']))
+        ann.save()
+        self.assertEqual(Author.get(ann.id).first_name, 'Ann')
+        
+        Author.upsert([Author(id=ann.id, first_name='Nope', last_name='Nope')], update_fields=[])
+        self.assertEqual(Author.get(ann.id).first_name, 'Ann')
+        
+        self.assertRaises(Model.ValidationError, Author.upsert,
+                          [Author(first_name='No', last_name='Id')])
+        
+    def testupsertunique(self):
+        path = tempfile.mktemp(suffix='.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE tag (id INTEGER PRIMARY KEY, name TEXT UNIQUE, n INTEGER)')
+        conn.execute("INSERT INTO tag (id, name, n) VALUES (1, 'a', 1)")
+        conn.commit()
+        conn.close()
+        
+        class Tag(Model):
+            db = util.AutoConn(path)
+            class Meta:
+                table = 'tag'
+        
+        # Matching on a unique column leaves the existing row's id alone
+        Tag.upsert([Tag(name='a', n=5)], conflict=('name',))
+        self.assertEqual([(t.id, t.n) for t in Tag.get()], [(1, 5)])
+        
+        # Objects without an id are written but not taken as saved
+        new = Tag(name='b', n=1)
+        Tag.upsert([new], conflict=('name',))
+        self.assert_(new._new_record)
+        self.assertEqual(Tag.get(name='b')[0].n, 1)
+        os.remove(path)
+        
+    def testadvisor(self):
+        plan = Author.get(first_name='Ann').explain()
+        self.assert_(isinstance(plan, list) and plan)
+        
+        Author.db.advisor = IndexAdvisor()
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always', FullScanWarning)
+                list(Author.get(first_name='Ann'))
+                list(Author.get(first_name='Bob'))
+                Author.get(id=1).count()
+            self.assertEqual(len(caught), 1)
+            self.assert_(issubclass(caught[0].category, FullScanWarning))
+            # The warning points at the code that ran the query
+            self.assertEqual(os.path.splitext(caught[0].filename)[0],
+                             os.path.splitext(__file__)[0])
+        finally:
+            advisor, Author.db.advisor = Author.db.advisor, None
+        self.assertEqual(advisor.suggestions, {'author': set([('first_name',)])})
+        self.assert_('(`first_name`)' in advisor.report())
+        
+        # IN (...) lookups from batch-loading relations count as filters
+        Book.db.advisor = IndexAdvisor(warn=False)
+        try:
+            Author.books # resolves the relation's model
+            list(Author.__dict__['books'].select_in('title', ['Ulysses']))
+        finally:
+            advisor, Book.db.advisor = Book.db.advisor, None
+        self.assertEqual(advisor.suggestions, {'books': set([('title',)])})
+        
+        # A Database never passed through connect() is taken as SQLite
+        db = DBConn()
+        db.conn = Database()
+        db.conn.connection = sqlite3.connect(':memory:')
+        Query.raw_sql('CREATE TABLE author (id INTEGER PRIMARY KEY, first_name TEXT, '
+                      'last_name TEXT, bio TEXT)', db=db)
+        self.assert_(Query(model=Author, conditions={}, db=db).explain())
+        
+    def testbatchrelations(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        
+        authors = []
+        for name in ('Ann', 'Bob', 'Cy'):
+            a = Author(first_name=name, last_name='Smith')
+            a.save()
+            authors.append(a)
+            Book(title='%s 1' % name, author_id=a.id).save()
+            Book(title='%s 2' % name, author_id=a.id).save()
+        Book(title='Anonymous', author_id=None).save()
+        
+        statements = []
+        raw_sql = Query.__dict__['raw_sql']
+        def counting_raw_sql(cls, sql, values=(), db=None):
+            statements.append(sql)
+            return raw_sql.__get__(None, cls)(sql, values, db)
+        Query.raw_sql = classmethod(counting_raw_sql)
+        try:
+            books = list(Book.get().order_by('id'))
+            names = [b.author and b.author.first_name for b in books]
+            self.assertEqual(names, ['Ann', 'Ann', 'Bob', 'Bob', 'Cy', 'Cy', None])
+            self.assertEqual(len(statements), 2)
+            
+            del statements[:]
+            titles = [[b.title for b in a.books] for a in Author.get().order_by('id')]
+            self.assertEqual(titles[1], ['Bob 1', 'Bob 2'])
+            self.assertEqual([len(t) for t in titles], [2, 2, 2])
+            self.assertEqual(len(statements), 2)
+            
+            # Siblings are only weakly held
+            del statements[:]
+            book = Book.get().order_by('id')[:][0]
+            self.assertEqual(book._get_siblings(), [book])
+            book.author
+            self.assertEqual(len(statements), 2)
+            
+            del statements[:]
+            for b in Book.get().batch_relations(False):
+                b.author
+            self.assertEqual(len(statements), 8)
+        finally:
+            Query.raw_sql = raw_sql
+        
+    def testrelationcache(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        
+        ann = Author(first_name='Ann', last_name='Smith')
+        ann.save()
+        bob = Author(first_name='Bob', last_name='Jones')
+        bob.save()
+        book = Book(title='One', author_id=ann.id)
+        book.save()
+        
+        # Memoized until the foreign key changes
+        self.assert_(book.author is book.author)
+        book.author_id = bob.id
+        self.assertEqual(book.author.first_name, 'Bob')
+        book.save()
+        
+        self.assertEqual(ann.books.count(), 0)
+        self.assertEqual(list(ann.books), [])
+        
+        # Rows loaded through one access are shared with the next
+        Book(title='Two', author_id=ann.id).save()
+        self.assertEqual([b.title for b in ann.books], [])
+        self.assertEqual(ann.books.cache, [])
+        
+        # refresh() reloads fields and forgets related objects
+        ann.refresh()
+        self.assertEqual(ann.books.cache, None)
+        self.assertEqual(ann.books.count(), 1)
+        self.assertEqual(ann.books[0].title, 'Two')
+        
+        # Slicing or filtering a relation doesn't narrow it
+        Book(title='Three', author_id=ann.id).save()
+        ann = Author.get(ann.id)
+        self.assertEqual(ann.books[0].title, 'Two')
+        self.assertEqual([b.title for b in ann.books], ['Two', 'Three'])
+        self.assertEqual(ann.books.count(), 2)
+        self.assertEqual([b.title for b in ann.books[1:2]], ['Three'])
+        self.assertEqual(len(ann.books), 2)
+        self.assertEqual([b.title for b in ann.books.filter(title='Three')], ['Three'])
+        self.assertEqual(len(ann.books), 2)
+        ann = Author.get(ann.id)
+        self.assertEqual(ann.books.filter(title='Three').count(), 1)
+        self.assertEqual(ann.books.count(), 2)
+        
+        Query.raw_sql('UPDATE author SET last_name = %s' % Author.db.conn.placeholder, ['Brown'])
+        ann.refresh()
+        self.assertEqual(ann.last_name, 'Brown')
+        ann.delete()
+        self.assertRaises(Model.DoesNotExist, ann.refresh)
+        
+    def testensureschema(self):
+        path = tempfile.mktemp(suffix='.db')
+        
+        class Shelf(Model):
+            db = util.AutoConn(path)
+            class Meta:
+                columns = (('id', 'INTEGER PRIMARY KEY'),
+                           ('room', 'VARCHAR(40)'),
+                           ('position', 'INTEGER'),
+                           ('label', 'VARCHAR(40)'))
+                indexes = (('room', 'position'), Index('label', unique=True))
+        
+        self.assertEqual(Shelf._fields, ['id', 'room', 'position', 'label'])
+        self.assertEqual(len(util.ensure_schema(Shelf)), 3)
+        self.assertEqual(util.ensure_schema(Shelf), [])
+        self.assert_((('label',), True) in existing_indexes(Shelf.db, 'shelf'))
+        
+        Shelf(room='A', position=1, label='A1').save()
+        self.assertEqual(Shelf.get(label='A1').count(), 1)
+        
+        # An index covering the same columns under another name counts
+        Query.raw_sql('CREATE INDEX other ON shelf (position)', db=Shelf.db)
+        Shelf.Meta.indexes.append(Index('position'))
+        self.assertEqual(util.ensure_schema(Shelf), [])
+        
+        # A bare string names one column
+        class Bin(Model):
+            db = Shelf.db
+            class Meta:
+                table = 'shelf'
+                indexes = ('room',)
+        self.assertEqual([i.columns for i in Bin.Meta.indexes], [('room',)])
+        self.assertEqual(len(util.ensure_schema(Bin)), 1)
+        os.remove(path)
+        
+    def testprofile(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'profile.db')
+        db = util.AutoConn(path, profile=PERFORMANCE_PROFILE)
+        settings = []
+        def check():
+            c = db.conn.connection
+            settings.append([c.execute('PRAGMA %s' % name).fetchone()[0]
+                             for name in ('journal_mode', 'synchronous', 'busy_timeout')])
+        threads = [threading.Thread(target=check) for n in range(2)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        # synchronous NORMAL is 1
+        self.assertEqual(settings, [['wal', 1, 5000]] * 2)
+        
+        # cached_statements reaches sqlite3.connect, not a PRAGMA
+        connect = sqlite3.connect
+        calls = []
+        def recording_connect(*args, **kwargs):
+            calls.append(kwargs)
+            return connect(*args, **kwargs)
+        sqlite3.connect = recording_connect
+        try:
+            util.AutoConn(path, profile=PERFORMANCE_PROFILE).conn
+        finally:
+            sqlite3.connect = connect
+        self.assertEqual(calls, [{'cached_statements': 256}])
+        shutil.rmtree(tmpdir)
+        
+    def testsinglewriter(self):
+        path = tempfile.mktemp(suffix='.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE note (id INTEGER PRIMARY KEY, body TEXT)')
+        conn.close()
+        
+        class Note(Model):
+            db = util.AutoConn(path, single_writer=True)
+        
+        def write(n):
+            for i in range(20):
+                Note(body='%d-%d' % (n, i)).save()
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(Note.get().count(), 80)
+        
+        note = Note(body='first')
+        note.save()
+        self.assertEqual(Note.get(note.id).body, 'first')
+        note.delete()
+        self.assertEqual(Note.get().count(), 80)
+        
+        pending = Note.db.writer.submit('INSERT INTO note (id, body) VALUES (?, ?)', (1, 'dup'))
+        self.assertRaises(sqlite3.IntegrityError, pending.wait)
+        
+        Note.db.writer.close()
+        self.assertRaises(util.WriteQueueError, Note.db.writer.submit, 'DELETE FROM note')
+        
+        # Options pass through AutoConn; writes come back unconfirmed
+        db = util.AutoConn(path, single_writer=True, wait=False, batch_size=10)
+        self.assertEqual(db.writer.batch_size, 10)
+        pending = Query.raw_sql('DELETE FROM note', db=db)
+        self.assert_(isinstance(pending, util.PendingWrite))
+        self.assertEqual(pending.wait(5).rowcount, 80)
+        
+        # A write that isn't confirmed in time raises
+        unconfirmed = util.PendingWrite('DELETE FROM note', ())
+        self.assertRaises(util.WriteQueueError, unconfirmed.wait, 0.01)
+        db.writer.close()
+        os.remove(path)
+        
+        # Unconfirmed writes are flushed when the interpreter exits
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE note (id INTEGER PRIMARY KEY, body TEXT)')
+        conn.close()
+        script = '''
+import sys
+from autumn import util
+from autumn.db.query import Query
+db = util.AutoConn(sys.argv[1], single_writer=True, wait=False, interval=0.5)
+for i in range(100):
+    Query.raw_sql("INSERT INTO note (body) VALUES ('x')", db=db)
+'''
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.check_call([sys.executable, '-c', script, path], env=env)
+        conn = sqlite3.connect(path)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM note').fetchone()[0], 100)
+        conn.close()
+        os.remove(path)
+        
+        # A writer thread that dies fails its writes instead of hanging
+        broken = util.WriteQueue('/nonexistent/dir/broken.db')
+        self.assertRaises(Exception, lambda: broken.submit('DELETE FROM note').wait(5))
+        broken.thread.join()
+        self.assertRaises(util.WriteQueueError, broken.submit, 'DELETE FROM note')
+        
     def testvalidators(self):
         ev = validators.Email()
         assert ev('test@example.com')
@@ -1,6 +1,11 @@
 # autumn.util.py
 
 
+import atexit
+import os
+import Queue
+import threading
+import time
 from threading import local as threading_local
 
 # Autumn ORM
@@ -8,6 +13,7 @@ from autumn.model import Model
 from autumn.db.relations import ForeignKey, OneToMany
 from autumn.db.query import Query
 from autumn.db.connection import Database
+from autumn.db import schema
 
 
 """
@@ -45,16 +51,57 @@ def create_table_if_needed(db, table_name, s_create_sql):
         create_table(db, s_create_sql)
 
 
+def ensure_schema(model, db=None):
+    """
+    Create an Autumn class's table (from ``Meta.columns``) and any of its
+    ``Meta.indexes`` missing from the database.  Safe to run repeatedly;
+    returns the statements that were executed.
+    """
+    db = db or model.db
+    table = model.Meta.table
+    statements = []
+    if not schema.table_exists(db, table):
+        columns = getattr(model.Meta, 'columns', None)
+        if not columns:
+            raise Exception('Table %s does not exist and %s.Meta.columns is not set'
+                            % (table, model.__name__))
+        statements.append(schema.create_table_sql(table, columns))
+        existing = []
+    else:
+        existing = schema.existing_indexes(db, table)
+    for index in getattr(model.Meta, 'indexes', ()):
+        if not index.satisfied_by(existing):
+            statements.append(index.create_sql(table))
+            existing.append((index.columns, index.unique))
+    for sql in statements:
+        Query.raw_sql(sql, db=db)
+    return statements
+
+
 class AutoConn(object):
     """
     A container that will automatically create a database connection object
     for each thread that accesses it.  Useful with SQLite, because the Python
     modules for SQLite require a different connection object for each thread.
+
+    Pass a ``profile`` (see ``autumn.db.connection.PERFORMANCE_PROFILE``) to
+    tune every per-thread connection as it is opened.
+
+    With ``single_writer=True`` every INSERT, UPDATE, DELETE and REPLACE is
+    handed to a ``WriteQueue`` instead, so only one connection ever writes.
+    Reads stay on the per-thread connections. Any other keyword arguments
+    (``batch_size``, ``interval``, ``wait``) are passed to the ``WriteQueue``.
     """
-    def __init__(self, db_name, container=None):
+    def __init__(self, db_name, container=None, profile=None, single_writer=False,
+                 **writer_options):
         self.b_debug = False
         self.b_commit = True
         self.db_name = db_name
+        self.profile = profile
+        self.writer = None
+        self.advisor = None
+        if single_writer:
+            self.writer = WriteQueue(db_name, profile, **writer_options)
         self.container = threading_local()
     def __getattr__(self, name):
         try:
@@ -62,16 +109,198 @@ class AutoConn(object):
                 return self.container.conn
         except BaseException:
             self.container.conn = Database()
-            self.container.conn.connect('sqlite3', self.db_name)
+            self.container.conn.connect('sqlite3', self.db_name, profile=self.profile)
             return self.container.conn
         raise AttributeError
 
 
+class WriteQueueError(Exception):
+    """
+    Raised for writes a ``WriteQueue`` can't take or confirm: the queue is
+    closed, its thread has stopped, or ``PendingWrite.wait()`` timed out.
+    """
+    pass
+
+
+class PendingWrite(object):
+    """
+    A write waiting on a ``WriteQueue``. ``wait()`` blocks until the batch
+    holding it has committed and re-raises any error from the statement.
+    Reading ``lastrowid`` or ``rowcount`` waits as well, so a
+    ``PendingWrite`` can stand in for the cursor ``Query.raw_sql`` returns.
+    """
+    def __init__(self, sql, values, many=False):
+        self.sql = sql
+        self.values = values
+        self.many = many
+        self.exception = None
+        self._lastrowid = None
+        self._rowcount = -1
+        self._done = threading.Event()
+    def done(self):
+        return self._done.is_set()
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise WriteQueueError('Timed out after %s seconds waiting for write' % timeout)
+        if self.exception is not None:
+            raise self.exception
+        return self
+    def _finish(self, exception=None):
+        if not self.done():
+            self.exception = self.exception or exception
+            self._done.set()
+    @property
+    def lastrowid(self):
+        return self.wait()._lastrowid
+    @property
+    def rowcount(self):
+        return self.wait()._rowcount
+
+
+class WriteQueue(object):
+    """
+    Serializes writes to a SQLite database through one dedicated thread.
+
+    Queued statements are grouped into a single transaction of at most
+    ``batch_size`` statements, collected for up to ``interval`` seconds.
+    ``submit()`` returns a ``PendingWrite``; ``execute()`` also waits for it
+    unless ``wait`` is False, in which case writes are confirmed lazily.
+    Explicit ``Query.begin()``/``Query.commit()`` do not apply to queued
+    writes; each batch is its own transaction.
+
+    ``close()`` runs at interpreter exit, so queued writes are not lost.
+    If the writer thread stops, whether from ``close()`` or an error, every
+    write still queued fails with that error, and ``submit()`` raises
+    ``WriteQueueError`` from then on. This includes forked processes, such
+    as ``Query.parallel_map`` workers, because the thread does not exist in
+    the child process.
+    """
+    write_verbs = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+    def __init__(self, db_name, profile=None, batch_size=500, interval=0.005, wait=True):
+        self.db_name = db_name
+        self.profile = profile
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wait = wait
+        self.closed = False
+        self.error = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='autumn-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        # Write out anything still queued (e.g. with wait=False) at exit
+        atexit.register(self.close)
+    def handles(self, sql):
+        'Returns True if ``sql`` is a statement this queue should run'
+        words = sql.split(None, 1)
+        return bool(words) and words[0].upper() in self.write_verbs
+    def submit(self, sql, values=(), many=False):
+        'Queues ``sql`` (run with ``executemany`` if ``many``)'
+        pending = PendingWrite(sql, values, many)
+        with self.lock:
+            if self.error is not None:
+                raise WriteQueueError('The writer thread stopped: %s' % self.error)
+            if self.closed or os.getpid() != self.pid or not self.thread.is_alive():
+                raise WriteQueueError('The write queue is not running')
+            self.queue.put(pending)
+        return pending
+    def execute(self, sql, values=(), many=False):
+        pending = self.submit(sql, values, many)
+        if self.wait:
+            pending.wait()
+        return pending
+    def close(self):
+        'Writes out everything queued so far and stops the writer thread'
+        if os.getpid() != self.pid:
+            return
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+        self.thread.join()
+    def _run(self):
+        batch = []
+        error = WriteQueueError('The write queue was closed')
+        try:
+            conn = Database()
+            conn.connect('sqlite3', self.db_name, profile=self.profile)
+            while True:
+                batch = []
+                pending = self.queue.get()
+                if pending is None:
+                    break
+                batch.append(pending)
+                deadline = time.time() + self.interval
+                while len(batch) < self.batch_size:
+                    try:
+                        pending = self.queue.get(timeout=max(deadline - time.time(), 0))
+                    except Queue.Empty:
+                        break
+                    if pending is None:
+                        self.queue.put(None)
+                        break
+                    batch.append(pending)
+                self._write(conn.connection, batch)
+            conn.connection.close()
+        except BaseException, ex:
+            error = self.error = ex
+        finally:
+            # Nothing can be queued after this, so fail whatever is left
+            with self.lock:
+                self.closed = True
+            for pending in batch:
+                pending._finish(error)
+            while True:
+                try:
+                    pending = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if pending is not None:
+                    pending._finish(error)
+    def _write(self, connection, batch):
+        cursor = connection.cursor()
+        for pending in batch:
+            try:
+                if pending.many:
+                    cursor.executemany(pending.sql, pending.values)
+                else:
+                    cursor.execute(pending.sql, pending.values)
+                pending._lastrowid = cursor.lastrowid
+                pending._rowcount = cursor.rowcount
+            except Exception, ex:
+                # SQLite only undoes the failed statement; the rest commit
+                pending.exception = ex
+        try:
+            connection.commit()
+        except Exception, ex:
+            connection.rollback()
+            for pending in batch:
+                pending.exception = pending.exception or ex
+        for pending in batch:
+            pending._finish()
+
+
 # examples of usage:
 #
 # class FooClass(object):
 #     db = autumn.util.AutoConn("foo.db")
 #
+# # or, tuned for write throughput
+# class FooClass(object):
+#     db = autumn.util.AutoConn("foo.db", profile=PERFORMANCE_PROFILE)
+#
+# # or, funnelling writes from every thread through one writer connection
+# class FooClass(object):
+#     db = autumn.util.AutoConn("foo.db", single_writer=True)
+#
+# # ... without waiting on each write; Query.raw_sql returns a PendingWrite
+# class FooClass(object):
+#     db = autumn.util.AutoConn("foo.db", single_writer=True, wait=False,
+#                               batch_size=1000, interval=0.05)
+#
 # _create_sql = "_create_sql = """\
 # DROP TABLE IF EXISTS bar;
 # CREATE TABLE bar (
@@ -84,3 +313,12 @@ class AutoConn(object):
 #
 # class Bar(FooClass, Model):
 #    ...standard Autumn class stuff goes here...
+#
+# # or declare the schema on the class and let Autumn create what's missing
+# class Bar(FooClass, Model):
+#     class Meta:
+#         columns = (('id', 'INTEGER PRIMARY KEY'),
+#                    ('value', 'VARCHAR(128) NOT NULL'))
+#         indexes = (Index('value', unique=True),)
+#
+# autumn.util.ensure_schema(Bar)